@@ -1,7 +1,15 @@
+import csv
+import functools
+import io
+import os
+import re
 import sqlite3
-from typing import Any, Dict, List
+import threading
+from pathlib import Path
+from typing import Any, Dict, List, Tuple
 
 import chromadb
+import numpy as np
 from openai import OpenAI
 from smolagents import Tool, ToolCallingAgent, OpenAIServerModel
 
@@ -12,6 +20,53 @@ def load_system_prompt(path: str) -> str:
         return f.read()
 
 
+@functools.lru_cache(maxsize=1)
+def _openai_client() -> OpenAI:
+    return OpenAI()
+
+
+@functools.lru_cache(maxsize=4)
+def _get_client(persist_dir: str) -> Any:
+    # PersistentClient opens SQLite and mmaps the HNSW index: do it once per dir.
+    # Collections are looked up per tool, so a rebuilt collection is picked up on reload.
+    return chromadb.PersistentClient(path=persist_dir)
+
+
+@functools.lru_cache(maxsize=1024)
+def _cached_embed(model: str, text: str) -> Tuple[float, ...]:
+    resp = _openai_client().embeddings.create(model=model, input=text)
+    return tuple(resp.data[0].embedding)
+
+
+# bit counts for every byte value, for Hamming distance over packed sign bits
+_POPCOUNT = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+
+BRAND_RE = re.compile(r"\b(toyota|lexus)\b", re.IGNORECASE)
+
+
+def _query_filters(text: str) -> Dict[str, Any] | None:
+    """Build a Chroma `where` pre-filter from the brand mentioned in the query.
+
+    Pages indexed with brand="" are generic (contracts, policies) and always pass.
+    Queries naming both brands are not filtered. Years are deliberately not used:
+    a year in a question usually means a sales/model year, not the manual edition.
+    """
+    brands = {m.lower() for m in BRAND_RE.findall(text)}
+    if len(brands) != 1:
+        return None
+    return {"$or": [{"brand": brands.pop()}, {"brand": ""}]}
+
+
+def _rows_to_csv(cols: List[str], rows: List[tuple]) -> str:
+    buf = io.StringIO()
+    w = csv.writer(buf, lineterminator="\n")
+    if cols:
+        w.writerow(cols)
+    w.writerows(rows)
+    return buf.getvalue()
+
+
 # --------- tools ---------
 class SqlSelectTool(Tool):
     name = "sql_select"
@@ -34,6 +89,25 @@ class SqlSelectTool(Tool):
     def __init__(self, db_path: str):
         super().__init__()
         self.db_path = db_path
+        # One long-lived connection: SQLite's page cache is per-connection,
+        # so hot pages stay in memory across tool calls; repeated SQL strings
+        # reuse their prepared statements from the statement cache.
+        # mode=ro: a missing file fails here instead of creating an empty db.
+        self.conn = sqlite3.connect(
+            f"{Path(db_path).resolve().as_uri()}?mode=ro",
+            uri=True,
+            check_same_thread=False,
+            cached_statements=256,
+        )
+        self.conn.execute("PRAGMA query_only=ON")
+        self.conn.execute("PRAGMA temp_store=MEMORY")
+        self.conn.execute("PRAGMA cache_size=-64000")
+        self._lock = threading.Lock()
+
+    def __del__(self):
+        conn = getattr(self, "conn", None)
+        if conn is not None:
+            conn.close()
 
     def forward(self, query: str | None = None, limit: int | None = 100) -> str:
         if not query or not str(query).strip():
@@ -43,23 +117,17 @@ class SqlSelectTool(Tool):
             return "Error: only SELECT queries are allowed."
         lim = int(limit) if (isinstance(limit, int) or str(limit).isdigit()) else 100
 
-        conn = sqlite3.connect(self.db_path)
-        try:
-            cur = conn.cursor()
-            cur.execute(q)
-            rows = cur.fetchmany(lim)
-            cols = [d[0] for d in cur.description] if cur.description else []
-        finally:
-            conn.close()
+        with self._lock:
+            cur = self.conn.cursor()
+            try:
+                cur.execute(q)
+                rows = cur.fetchmany(lim)
+                cols = [d[0] for d in cur.description] if cur.description else []
+            finally:
+                cur.close()
 
         # Return as simple CSV text
-        import io, csv
-        buf = io.StringIO()
-        w = csv.writer(buf)
-        if cols:
-            w.writerow(cols)
-        w.writerows(rows)
-        return buf.getvalue().strip() or "(no rows)"
+        return _rows_to_csv(cols, rows).strip() or "(no rows)"
 
 
 class ChromaRagTool(Tool):
@@ -88,31 +156,82 @@ class ChromaRagTool(Tool):
         persist_dir: str,
         collection_name: str,
         embedding_model: str = "text-embedding-3-small",
+        rerank_candidates: int = 200,
     ):
         super().__init__()
-        self.client = chromadb.PersistentClient(path=persist_dir)
+        self.client = _get_client(persist_dir)
         self.collection = self.client.get_collection(collection_name)
-        self.oai = OpenAI()
         self.embedding_model = embedding_model
+        self.rerank_candidates = rerank_candidates
 
-    def _embed(self, text: str) -> List[float]:
-        resp = self.oai.embeddings.create(model=self.embedding_model, input=text)
-        return resp.data[0].embedding
+        # Optional sidecar from BuildEmbeddings(binary_index=True)
+        self.binary_ids = self.binary_codes = None
+        binary_path = os.path.join(persist_dir, f"{collection_name}.binary.npz")
+        if os.path.exists(binary_path):
+            with np.load(binary_path) as data:
+                self.binary_ids, self.binary_codes = data["ids"], data["codes"]
+            if len(self.binary_ids) != self.collection.count():
+                # Out of sync with the collection: new chunks would never be candidates
+                print(f"Ignoring outdated binary index {binary_path}")
+                self.binary_ids = self.binary_codes = None
 
-    def forward(self, query: str | None = None, k: int | None = 5) -> str:
-        if not query or not str(query).strip():
-            return "Error: 'query' is required."
-        topk = int(k) if (isinstance(k, int) or str(k).isdigit()) else 5
+    def _embed(self, text: str) -> List[float]:
+        # Collapse whitespace so trivially different phrasings share a cache entry
+        return list(_cached_embed(self.embedding_model, " ".join(text.split())))
 
-        qvec = self._embed(str(query))
+    def _search(
+        self, qvec: List[float], topk: int, where: Dict[str, Any] | None
+    ) -> Tuple[List[str], List[Dict[str, Any]], List[float]]:
+        if self.binary_codes is not None and len(self.binary_ids):
+            return self._binary_search(qvec, topk, where)
         res: Dict[str, Any] = self.collection.query(
             query_embeddings=[qvec],
             n_results=topk,
+            where=where,
             include=["documents", "metadatas", "distances"],
         )
         docs = (res.get("documents") or [[]])[0]
         metas = (res.get("metadatas") or [[]])[0]
         dists = (res.get("distances") or [[]])[0]
+        return docs, metas, dists
+
+    def _binary_search(
+        self, qvec: List[float], topk: int, where: Dict[str, Any] | None
+    ) -> Tuple[List[str], List[Dict[str, Any]], List[float]]:
+        # Candidates by Hamming distance on 1-bit codes, then float cosine rerank
+        q = np.asarray(qvec, dtype=np.float32)
+        qcode = np.packbits(q > 0)
+        hamming = _POPCOUNT[np.bitwise_xor(self.binary_codes, qcode)].sum(axis=1, dtype=np.int32)
+        n_cand = min(max(self.rerank_candidates, topk), len(hamming))
+        cand = np.argpartition(hamming, n_cand - 1)[:n_cand]
+
+        res: Dict[str, Any] = self.collection.get(
+            ids=self.binary_ids[cand].tolist(),
+            where=where,
+            include=["embeddings", "documents", "metadatas"],
+        )
+        if not res.get("ids"):
+            return [], [], []
+        vecs = np.asarray(res["embeddings"], dtype=np.float32)
+        sims = vecs @ q / (np.linalg.norm(vecs, axis=1) * np.linalg.norm(q) + 1e-12)
+        order = np.argsort(-sims)[:topk]
+        return (
+            [res["documents"][i] for i in order],
+            [res["metadatas"][i] for i in order],
+            [float(1.0 - sims[i]) for i in order],
+        )
+
+    def forward(self, query: str | None = None, k: int | None = 5) -> str:
+        if not query or not str(query).strip():
+            return "Error: 'query' is required."
+        topk = int(k) if (isinstance(k, int) or str(k).isdigit()) else 5
+
+        qvec = self._embed(str(query))
+        where = _query_filters(str(query))
+        docs, metas, dists = self._search(qvec, topk, where)
+        if where and not docs:
+            # Index built without brand metadata, or nothing matched: search unfiltered
+            docs, metas, dists = self._search(qvec, topk, None)
 
         if not docs:
             return "No relevant passages found."
@@ -122,30 +241,46 @@ class ChromaRagTool(Tool):
             meta = meta or {}
             src = meta.get("file_path") or meta.get("source") or "unknown"
             page = meta.get("page") or meta.get("page_number")
-            parts.append(f"[{i}] score={dist:.4f} source={src} page={page}\n{doc.strip()}")
+            page_end = meta.get("page_end")
+            pages = f"page={page}" if not page_end or page_end == page else f"pages={page}-{page_end}"
+            parts.append(f"[{i}] score={dist:.4f} source={src} {pages}\n{doc.strip()}")
         return "\n\n".join(parts)
 
 
 # --------- agent wiring ---------
+def build_tools(
+    db_path: str = "toyota.db",
+    chroma_dir: str = "chroma",
+    collection_name: str = "docs",
+) -> List[Tool]:
+    """The expensive, shareable part of the agent: DB connection and Chroma collection."""
+    sql_tool = SqlSelectTool(db_path=db_path)
+    rag_tool = ChromaRagTool(persist_dir=chroma_dir, collection_name=collection_name)
+    return [sql_tool, rag_tool]
+
+
 def build_agent(
     system_prompt_path: str = "system_prompt.txt",
     db_path: str = "toyota.db",
     chroma_dir: str = "chroma",
     collection_name: str = "docs",
+    tools: List[Tool] | None = None,
 ) -> ToolCallingAgent:
     system_prompt = load_system_prompt(system_prompt_path)
 
-    sql_tool = SqlSelectTool(db_path=db_path)
-    rag_tool = ChromaRagTool(persist_dir=chroma_dir, collection_name=collection_name)
+    # Agents keep per-run memory, so each caller gets its own; tools may be shared
+    if tools is None:
+        tools = build_tools(db_path=db_path, chroma_dir=chroma_dir, collection_name=collection_name)
 
     model = OpenAIServerModel(model_id="gpt-4o")
 
     agent = ToolCallingAgent(
-        tools=[sql_tool, rag_tool],
+        tools=tools,
         model=model,
         instructions=system_prompt,
         verbosity_level=2,
         max_steps=8,
+        stream_outputs=True,
     )
     return agent
 
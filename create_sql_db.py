@@ -11,6 +11,11 @@ def create_sqlite_from_csvs(csv_dir: str, db_file: str):
         os.remove(db_file)
 
     conn = sqlite3.connect(db_file)
+    # bulk-load settings: the db is rebuilt from scratch, so durability doesn't matter here
+    conn.execute("PRAGMA journal_mode=OFF")
+    conn.execute("PRAGMA synchronous=OFF")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    conn.execute("PRAGMA locking_mode=EXCLUSIVE")
 
     for file in os.listdir(csv_dir):
         if file.endswith(".csv"):
@@ -23,6 +28,8 @@ def create_sqlite_from_csvs(csv_dir: str, db_file: str):
             # write into SQL (replace if exists)
             df.to_sql(table_name, conn, if_exists="replace", index=False)
 
+    # back to defaults so readers get a normal, journaled db
+    conn.execute("PRAGMA journal_mode=DELETE")
     conn.close()
     print(f"Done. SQLite DB saved at: {db_file}")
 
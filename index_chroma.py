@@ -1,21 +1,112 @@
 import os
-from typing import List, Iterable, Tuple, Dict, Any, Union
+import asyncio
+from hashlib import blake2b
+from concurrent.futures import ProcessPoolExecutor
+from typing import List, Iterable, Iterator, Tuple, Dict, Any, Union
 import chromadb
+import numpy as np
+import tiktoken
 from chromadb.utils import embedding_functions
 from chromadb.api.types import Documents, Embeddings
-from openai import OpenAI
-from PyPDF2 import PdfReader
+from openai import AsyncOpenAI, OpenAI
+import fitz  # PyMuPDF
+
+KNOWN_BRANDS = {"toyota", "lexus"}
+
+
+def extract_pdf_pages(file_path: str) -> List[Tuple[int, str]]:
+    """Extract non-empty page texts from a PDF. Top-level so it can run in a process pool."""
+    pages: List[Tuple[int, str]] = []
+    with fitz.open(file_path) as doc:
+        for i, page in enumerate(doc, start=1):
+            try:
+                text = page.get_text("text") or ""
+            except Exception:
+                text = ""
+            text = text.strip()
+            if text:
+                pages.append((i, text))
+    return pages
+
+
+def pack_pages(
+    pages: Iterable[Tuple[int, str]],
+    encoding: tiktoken.Encoding,
+    chunk_tokens: int = 400,
+    overlap_tokens: int = 50,
+    max_tokens: int = 2000,
+) -> Iterator[Tuple[int, int, str]]:
+    """Pack consecutive pages into chunks of at least `chunk_tokens` and at most `max_tokens` tokens.
+
+    Pages are kept whole unless a single page is longer than `max_tokens`, in which case it is
+    cut into slices. Each chunk starts with the last `overlap_tokens` tokens of the previous
+    one when they fit. Yields (first_page, last_page, text).
+    """
+    buf: List[int] = []
+    fresh = 0  # pages added since the last chunk was emitted
+    first = last = 0
+    for page_num, text in pages:
+        toks = encoding.encode(text + "\n")
+        if fresh and len(buf) + len(toks) > max_tokens:
+            # this page would push the chunk past the cap: emit what we have first
+            yield first, last, encoding.decode(buf).strip()
+            buf = buf[-overlap_tokens:] if overlap_tokens > 0 else []
+            fresh = 0
+            first = last
+        if len(buf) + len(toks) > max_tokens:
+            buf = []  # only carried-over overlap is left; it doesn't fit
+        if not buf:
+            first = page_num
+        while len(toks) > max_tokens:
+            yield page_num, page_num, encoding.decode(toks[:max_tokens]).strip()
+            toks = toks[max_tokens - overlap_tokens:]
+        buf.extend(toks)
+        fresh += 1
+        last = page_num
+        if len(buf) >= chunk_tokens:
+            yield first, last, encoding.decode(buf).strip()
+            buf = buf[-overlap_tokens:] if overlap_tokens > 0 else []
+            fresh = 0
+            first = last
+    if fresh:
+        yield first, last, encoding.decode(buf).strip()
+
+
+def content_hash(text: str) -> str:
+    return blake2b(text.encode("utf-8"), digest_size=16).hexdigest()
+
 
 class OpenAIEmbeddingFunction(embedding_functions.EmbeddingFunction):
     """Chroma-compatible embedding function using OpenAI Embeddings API."""
 
-    def __init__(self, model: str = "text-embedding-3-small", api_key: str | None = None):
+    def __init__(
+        self,
+        model: str = "text-embedding-3-small",
+        api_key: str | None = None,
+        max_inputs_per_request: int = 256,
+    ):
         self.model = model
+        self.api_key = api_key
         self.client = OpenAI(api_key=api_key)
+        # OpenAI accepts at most 2048 inputs per embeddings request
+        self.max_inputs_per_request = max(1, min(int(max_inputs_per_request), 2048))
 
     def __call__(self, input: Documents) -> Embeddings:
-        resp = self.client.embeddings.create(model=self.model, input=input)
-        return [d.embedding for d in resp.data]
+        out: Embeddings = []
+        step = self.max_inputs_per_request
+        for start in range(0, len(input), step):
+            resp = self.client.embeddings.create(model=self.model, input=list(input[start:start + step]))
+            out.extend(d.embedding for d in resp.data)
+        return out
+
+    async def acall(self, input: Documents, client: AsyncOpenAI) -> Embeddings:
+        """Async variant of __call__; sub-requests run concurrently, order is preserved."""
+        step = self.max_inputs_per_request
+        chunks = [list(input[start:start + step]) for start in range(0, len(input), step)]
+        resps = await asyncio.gather(
+            *(client.embeddings.create(model=self.model, input=chunk) for chunk in chunks)
+        )
+        return [d.embedding for resp in resps for d in resp.data]
 
 
 class BuildEmbeddings:
@@ -26,10 +117,17 @@ class BuildEmbeddings:
         persist_dir: str = "./chroma",
         recursive: bool = True,
         allowed_ext: set[str] = {".pdf"},
-        batch_size: int = 64,
+        batch_size: int = 256,
         embed_model: str = "text-embedding-3-small",
         openai_api_key: str | None = None,
         distance: str = "cosine",
+        max_inputs_per_request: int = 256,
+        max_concurrency: int = 5,
+        max_workers: int | None = None,
+        chunk_tokens: int = 400,
+        chunk_overlap: int = 50,
+        chunk_max_tokens: int = 2000,
+        binary_index: bool = False,
     ):
         self.source_dirs = [source_dir] if isinstance(source_dir, str) else list(source_dir)
         self.collection_name = collection_name
@@ -37,13 +135,31 @@ class BuildEmbeddings:
         self.recursive = recursive
         self.allowed_ext = allowed_ext
         self.batch_size = batch_size
+        self.max_concurrency = max(1, int(max_concurrency))
+        self.max_workers = max_workers
+        self.chunk_tokens = chunk_tokens
+        self.chunk_overlap = chunk_overlap
+        # hard cap: text-embedding-3-* rejects inputs over 8191 tokens, failing the whole request
+        self.chunk_max_tokens = max(min(chunk_max_tokens, 8000), chunk_tokens, chunk_overlap + 1)
+        self._encoding = tiktoken.encoding_for_model(embed_model)
+        self.binary_index = binary_index
 
         self._client = chromadb.PersistentClient(path=self.persist_dir)
-        self._ef = OpenAIEmbeddingFunction(model=embed_model, api_key=openai_api_key)
+        self._ef = OpenAIEmbeddingFunction(
+            model=embed_model,
+            api_key=openai_api_key,
+            max_inputs_per_request=max_inputs_per_request,
+        )
         self.collection = self._client.get_or_create_collection(
             name=self.collection_name,
             embedding_function=self._ef,
-            metadata={"hnsw:space": distance},
+            # HNSW params only apply when the collection is first created
+            metadata={
+                "hnsw:space": distance,
+                "hnsw:M": 32,
+                "hnsw:construction_ef": 200,
+                "hnsw:search_ef": 128,
+            },
         )
 
     def _iter_files(self) -> Iterable[str]:
@@ -61,85 +177,238 @@ class BuildEmbeddings:
                     if os.path.isfile(full) and os.path.splitext(f)[1].lower() in self.allowed_ext:
                         yield full
 
-    def _count_total_pages(self, files: List[str]) -> int:
-        total = 0
-        for fp in files:
-            try:
-                reader = PdfReader(fp)
-                total += len(reader.pages)
-            except Exception:
-                continue
-        return total
-
-    def _page_key(self, file_path: str, page_num: int) -> str:
+    def _chunk_key(self, file_path: str, chunk_idx: int) -> str:
         rel = os.path.relpath(file_path)
-        return f"{rel}::page:{page_num}"
+        return f"{rel}::chunk:{chunk_idx}"
+
+    def _file_facets(self, file_path: str) -> Dict[str, Any]:
+        """brand/model/year from scraper-style names (brand.model.modelType.year.partNumber.pdf).
+
+        Files that don't follow the pattern get brand="", model="", year=0, meaning "applies to all".
+        """
+        segments = os.path.splitext(os.path.basename(file_path))[0].split(".")
+        brand = segments[0].lower() if segments[0].lower() in KNOWN_BRANDS else ""
+        model = segments[1].lower() if brand and len(segments) > 1 else ""
+        year = next((int(s) for s in segments[2:] if s.isdigit() and 1990 <= int(s) <= 2100), 0)
+        return {"brand": brand, "model": model, "year": year}
 
-    def _page_metadata(self, file_path: str, page_num: int) -> Dict[str, Any]:
+    def _chunk_metadata(self, file_path: str, page_num: int, page_end: int) -> Dict[str, Any]:
         rel = os.path.relpath(file_path)
         base = os.path.basename(file_path)
         return {
             "source": rel,
             "file": base,
             "page": page_num,
+            "page_end": page_end,
             "file_page": f"{base}_{page_num}",
             "uri": f"{rel}#page={page_num}",
+            **self._file_facets(file_path),
         }
 
-    def _iter_pages(self, file_path: str) -> Iterable[Tuple[int, str]]:
-        reader = PdfReader(file_path)
-        for i, page in enumerate(reader.pages, start=1):
-            try:
-                text = page.extract_text() or ""
-            except Exception:
-                text = ""
-            text = text.strip()
-            if text:
-                yield i, text
-
     def build(self) -> int:
+        return asyncio.run(self.abuild())
+
+    async def abuild(self) -> int:
         files = list(self._iter_files())
-        total_pages = self._count_total_pages(files)
-        if total_pages == 0:
+        if not files:
             print("No pages to index.")
             return 0
 
         done = 0
+        duplicates = 0
+        seen_hashes: set[str] = set()
         docs: List[str] = []
         metas: List[Dict[str, Any]] = []
         ids: List[str] = []
 
-        for fp in files:
-            for page_num, text in self._iter_pages(fp):
-                docs.append(text)
-                metas.append(self._page_metadata(fp, page_num))
-                ids.append(self._page_key(fp, page_num))
-                done += 1
+        # Bounds the number of embedding batches in flight (and buffered in memory)
+        sem = asyncio.Semaphore(self.max_concurrency)
+        # Chroma calls run in worker threads; upserts go through one writer at a time
+        write_lock = asyncio.Lock()
+        tasks: List[asyncio.Task] = []
+
+        loop = asyncio.get_running_loop()
+
+        with ProcessPoolExecutor(max_workers=self.max_workers) as pool:
+            async with AsyncOpenAI(api_key=self._ef.api_key) as aclient:
+
+                async def dispatch(b_ids: List[str], b_docs: List[str], b_metas: List[Dict[str, Any]]) -> None:
+                    await sem.acquire()
+                    tasks.append(asyncio.create_task(self._embed_and_flush(aclient, sem, write_lock, b_ids, b_docs, b_metas)))
+                    # Let the new task send its request before collecting more pages
+                    await asyncio.sleep(0)
 
-                if done % self.batch_size == 0 or done == total_pages:
-                    pct = (done / total_pages) * 100
-                    print(f"[{done}/{total_pages}] {pct:.1f}% indexed", flush=True)
+                # PDF text extraction is CPU-bound: spread files across cores, consume in order
+                extractions = [loop.run_in_executor(pool, extract_pdf_pages, fp) for fp in files]
 
-                # Flush by batch
-                if len(docs) >= self.batch_size:
-                    self._flush_batch(ids, docs, metas)
-                    ids, docs, metas = [], [], []
+                for file_idx, (fp, extraction) in enumerate(zip(files, extractions), start=1):
+                    # Each PDF is opened once, by the worker; progress is reported per file
+                    try:
+                        pages = await extraction
+                    except Exception as e:
+                        print(f"[{file_idx}/{len(files)}] skipped {fp}: {e}", flush=True)
+                        continue
 
-        # Flush tail
-        if docs:
-            self._flush_batch(ids, docs, metas)
+                    # Boilerplate pages (disclaimers, TOC filler) repeat across manuals: embed once.
+                    # A dropped page ends the packing run, so a chunk's page range never spans it.
+                    runs: List[List[Tuple[int, str]]] = [[]]
+                    for page_num, text in pages:
+                        h = content_hash(text)
+                        if h in seen_hashes:
+                            duplicates += 1
+                            if runs[-1]:
+                                runs.append([])
+                            continue
+                        seen_hashes.add(h)
+                        runs[-1].append((page_num, text))
 
+                    chunks = [
+                        chunk
+                        for run in runs
+                        for chunk in pack_pages(
+                            run, self._encoding, self.chunk_tokens, self.chunk_overlap, self.chunk_max_tokens
+                        )
+                    ]
+                    file_ids: set[str] = set()
+                    for chunk_idx, (first_page, last_page, text) in enumerate(chunks):
+                        docs.append(text)
+                        metas.append({
+                            **self._chunk_metadata(fp, first_page, last_page),
+                            "content_hash": content_hash(text),
+                        })
+                        ids.append(self._chunk_key(fp, chunk_idx))
+                        file_ids.add(ids[-1])
+                        done += 1
+
+                        # Flush by batch
+                        if len(docs) >= self.batch_size:
+                            await dispatch(ids, docs, metas)
+                            ids, docs, metas = [], [], []
+
+                    # Chunk ids are positional: drop this file's entries beyond the new chunk list
+                    async with write_lock:
+                        stale = await asyncio.to_thread(self._delete_stale, fp, file_ids)
+
+                    print(
+                        f"[{file_idx}/{len(files)}] {len(pages)} pages from {fp} ({done} chunks total"
+                        + (f", {stale} stale removed)" if stale else ")"),
+                        flush=True,
+                    )
+
+                # Flush tail
+                if docs:
+                    await dispatch(ids, docs, metas)
+
+                failed = sum(await asyncio.gather(*tasks))
+
+        if failed:
+            print(f"{failed} chunks failed to index; re-run to retry them", flush=True)
+            done -= failed
+        if duplicates:
+            print(f"Skipped {duplicates} duplicate pages", flush=True)
+        if self.binary_index:
+            print(f"Binary index written to {self.export_binary_index()}", flush=True)
+        elif os.path.exists(self._binary_index_path()):
+            # A sidecar from an earlier build would hide every chunk added since
+            os.remove(self._binary_index_path())
+            print(f"Removed outdated binary index {self._binary_index_path()}", flush=True)
         return done
 
-    def _flush_batch(self, ids: List[str], docs: List[str], metas: List[Dict[str, Any]]) -> None:
+    def _binary_index_path(self) -> str:
+        return os.path.join(self.persist_dir, f"{self.collection_name}.binary.npz")
+
+    def export_binary_index(self, page_size: int = 5000) -> str:
+        """Write sign-quantized (1 bit/dim) codes of every stored embedding next to the collection.
+
+        ChromaRagTool scans these by Hamming distance for candidates, then reranks with float cosine.
+        """
+        ids: List[str] = []
+        codes: List[np.ndarray] = []
+        offset = 0
+        while True:
+            page = self.collection.get(include=["embeddings"], limit=page_size, offset=offset)
+            page_ids = page.get("ids") or []
+            if not page_ids:
+                break
+            ids.extend(page_ids)
+            codes.append(np.packbits(np.asarray(page["embeddings"]) > 0, axis=1))
+            offset += len(page_ids)
+
+        path = self._binary_index_path()
+        np.savez(
+            path,
+            ids=np.asarray(ids, dtype=str),
+            codes=np.concatenate(codes) if codes else np.zeros((0, 0), dtype=np.uint8),
+        )
+        return path
+
+    async def _embed_and_flush(
+        self,
+        aclient: AsyncOpenAI,
+        sem: asyncio.Semaphore,
+        write_lock: asyncio.Lock,
+        ids: List[str],
+        docs: List[str],
+        metas: List[Dict[str, Any]],
+    ) -> int:
+        """Embed and store one batch; returns how many chunks failed (0 or the batch size)."""
+        try:
+            # Chroma reads/writes are blocking: keep them off the event loop
+            ids, docs, metas = await asyncio.to_thread(self._drop_unchanged, ids, docs, metas)
+            if not ids:
+                return 0
+            vectors = await self._ef.acall(docs, aclient)
+            async with write_lock:
+                await asyncio.to_thread(self._flush_batch, ids, docs, metas, vectors)
+            return 0
+        except Exception as e:
+            # One bad batch shouldn't abort the build; its chunks are retried on the next run
+            print(f"Batch {ids[0]} .. {ids[-1]} failed: {e}", flush=True)
+            return len(ids)
+        finally:
+            sem.release()
+
+    def _delete_stale(self, file_path: str, keep_ids: set[str]) -> int:
+        """Delete entries of `file_path` whose ids are not in `keep_ids`; returns how many."""
+        existing = self.collection.get(where={"source": os.path.relpath(file_path)}, include=[])
+        stale = [i for i in existing.get("ids") or [] if i not in keep_ids]
+        if stale:
+            self.collection.delete(ids=stale)
+        return len(stale)
+
+    def _drop_unchanged(
+        self,
+        ids: List[str],
+        docs: List[str],
+        metas: List[Dict[str, Any]],
+    ) -> Tuple[List[str], List[str], List[Dict[str, Any]]]:
+        """Skip pages already indexed with the same content, so re-runs only embed what changed."""
+        existing = self.collection.get(ids=ids, include=["metadatas"])
+        indexed = {
+            i: (m or {}).get("content_hash")
+            for i, m in zip(existing.get("ids") or [], existing.get("metadatas") or [])
+        }
+        keep = [n for n, (i, m) in enumerate(zip(ids, metas)) if indexed.get(i) != m["content_hash"]]
+        return [ids[n] for n in keep], [docs[n] for n in keep], [metas[n] for n in keep]
+
+    def _flush_batch(
+        self,
+        ids: List[str],
+        docs: List[str],
+        metas: List[Dict[str, Any]],
+        embeddings: Embeddings | None = None,
+    ) -> None:
+        # Always hand Chroma explicit vectors: batch sizing and concurrency stay under our control
+        if embeddings is None:
+            embeddings = self._ef(docs)
         try:
-            self.collection.upsert(ids=ids, documents=docs, metadatas=metas)
+            self.collection.upsert(ids=ids, embeddings=embeddings, documents=docs, metadatas=metas)
         except AttributeError:
             try:
                 self.collection.delete(ids=ids)
             except Exception:
                 pass
-            self.collection.add(ids=ids, documents=docs, metadatas=metas)
+            self.collection.add(ids=ids, embeddings=embeddings, documents=docs, metadatas=metas)
 
 
 def main():
@@ -149,13 +418,19 @@ def main():
         persist_dir="./chroma",
         recursive=True,
         allowed_ext={".pdf"},
-        batch_size=64,
+        batch_size=256,
         embed_model="text-embedding-3-small",
         openai_api_key=os.getenv("OPENAI_API_KEY"),
         distance="cosine",
+        max_inputs_per_request=int(os.getenv("EMBEDDING_OPENAI_BATCH_SIZE", "256")),
+        max_concurrency=5,
+        chunk_tokens=400,
+        chunk_overlap=50,
+        chunk_max_tokens=2000,
+        binary_index=False,
     )
     total = builder.build()
-    print(f"Indexed pages: {total}")
+    print(f"Indexed chunks: {total}")
 
 
 if __name__ == "__main__":
@@ -1,12 +1,14 @@
 import os
 import json
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from typing import Any, Dict, List, Optional, Tuple
 from datetime import datetime, date
 import requests
 from bs4 import BeautifulSoup
 from urllib.parse import quote
 from requests.adapters import HTTPAdapter, Retry
-from collections import defaultdict
+from collections import defaultdict, deque
 
 API = "https://diva-api.tweddle.app"
 PORTAL = "https://customerportal.tweddle-aws.eu"
@@ -16,6 +18,7 @@ PRODUCT_LIMIT = 15
 OUT_DIR = "./manuals"
 USE_SIBLING_YEARS = True
 MERGE_PRODUCTS = True
+PARALLEL_PRODUCTS = 8    # products fetched concurrently
 
 session = requests.Session()
 session.headers.update({
@@ -31,7 +34,8 @@ session.mount(
             backoff_factor=0.3,
             status_forcelist=[429, 502, 503, 504],
             allowed_methods=["GET"],
-        )
+        ),
+        pool_maxsize=PARALLEL_PRODUCTS,
     ),
 )
 
@@ -123,13 +127,19 @@ def parse_next_data(html: str) -> Optional[Dict[str, Any]]:
         return None
 
 def collect_publications(next_data: Dict[str, Any]) -> List[Dict[str, Any]]:
-    found: List[Dict[str, Any]] = []
-
-    def visit(node: Any):
-        if isinstance(node, dict):
-            if "partNumber" in node:
-                found.append({
-                    "partNumber":      node.get("partNumber"),
+    # Iterative pre-order walk (same visiting order as a recursive one), deduped by partNumber
+    uniq: Dict[str, Dict[str, Any]] = {}
+    stack = deque([next_data])
+    pop, extend = stack.pop, stack.extend
+    _isinstance = isinstance
+
+    while stack:
+        node = pop()
+        if _isinstance(node, dict):
+            pn = node.get("partNumber")
+            if pn:
+                uniq[pn] = {
+                    "partNumber":      pn,
                     "publicationType": node.get("publicationType") or node.get("type") or node.get("category"),
                     "language":        node.get("language") or node.get("lang") or node.get("locale"),
                     "title":           node.get("title") or node.get("name") or node.get("label"),
@@ -137,20 +147,14 @@ def collect_publications(next_data: Dict[str, Any]) -> List[Dict[str, Any]]:
                     "modelType":       node.get("modelType") or node.get("model") or "",
                     "ngtdModelId":     node.get("ngtdModelId") or node.get("modelId") or "",
                     "year":            node.get("year"),
-                })
-            for v in node.values():
-                visit(v)
-        elif isinstance(node, list):
-            for v in node:
-                visit(v)
-
-    visit(next_data)
+                }
+            children = [v for v in node.values() if _isinstance(v, (dict, list))]
+        elif _isinstance(node, list):
+            children = [v for v in node if _isinstance(v, (dict, list))]
+        else:
+            continue
+        extend(reversed(children))
 
-    uniq: Dict[str, Dict[str, Any]] = {}
-    for x in found:
-        pn = x.get("partNumber")
-        if pn:
-            uniq[pn] = x
     return list(uniq.values())
 
 def pick_latest_en_om(pubs: List[Dict[str, Any]]) -> Optional[Dict[str, Any]]:
@@ -233,60 +237,76 @@ def download_pdf(url: str, prod: Dict[str, Any], pub: Dict[str, Any]) -> Optiona
         return path
 
     print(f"Downloading PDF -> {path}")
+    # products are processed concurrently: write to a per-thread temp file, then rename
+    tmp_path = f"{path}.{threading.get_ident()}.part"
     with session.get(url, stream=True, timeout=120) as r:
         r.raise_for_status()
         ctype = r.headers.get("Content-Type", "")
         if "pdf" not in ctype.lower():
             print(f"Warning: unexpected Content-Type: {ctype}")
-        with open(path, "wb") as f:
+        with open(tmp_path, "wb") as f:
             for chunk in r.iter_content(1024 * 64):
                 if chunk:
                     f.write(chunk)
+    os.replace(tmp_path, path)
     print("Saved:", path)
     return path
 
 # ---------------------- main ----------------------
 
-def main():
-    all_products = get_products()
+def process_product(idx: int, total: int, p: Dict[str, Any], all_products: List[Dict[str, Any]]) -> Optional[str]:
+    years = pick_years_for_product(p, all_products)
+    pub_url = build_publications_url(p, years=years, language="en")
+    tag = f"[{idx}/{total}]"
 
-    if MERGE_PRODUCTS:
-        base_list = merge_products_latest(all_products)
-    else:
-        base_list = all_products
+    print(f"\n{tag} {p.get('brand')} | {p.get('model')} | {p.get('modelType')} | years={years}")
+    print(f"{tag} Publications page:", pub_url)
 
-    products = base_list[:PRODUCT_LIMIT] if PRODUCT_LIMIT else base_list
+    html = session.get(pub_url, timeout=REQUEST_TIMEOUT).text
+    next_data = parse_next_data(html)
+    if not next_data:
+        print(f"{tag} No __NEXT_DATA__ found")
+        return None
 
-    for idx, p in enumerate(products, 1):
-        years = pick_years_for_product(p, all_products)
-        pub_url = build_publications_url(p, years=years, language="en")
+    pubs = collect_publications(next_data)
+    print(f"{tag} Publications in page: {len(pubs)}")
 
-        print(f"\n[{idx}/{len(products)}] {p.get('brand')} | {p.get('model')} | {p.get('modelType')} | years={years}")
-        print("Publications page:", pub_url)
+    om = pick_latest_en_om(pubs)
+    if not om:
+        print(f"{tag} No EN Owner's Manual on this page.")
+        return None
 
-        html = session.get(pub_url, timeout=REQUEST_TIMEOUT).text
-        next_data = parse_next_data(html)
-        if not next_data:
-            print("No __NEXT_DATA__ found")
-            continue
+    print(f"\n{tag} Selected OM publication:")
+    print(json.dumps(om, indent=2))
 
-        pubs = collect_publications(next_data)
-        print(f"Publications in page: {len(pubs)}")
+    pdf_url = get_pdf_link(om)
+    print(f"{tag} Direct PDF URL:", pdf_url)
+    if not pdf_url:
+        return None
 
-        om = pick_latest_en_om(pubs)
-        if not om:
-            print("No EN Owner's Manual on this page.")
-            continue
+    return download_pdf(pdf_url, p, om)
 
-        print("\nSelected OM publication:")
-        print(json.dumps(om, indent=2))
+def main():
+    all_products = get_products()
 
-        pdf_url = get_pdf_link(om)
-        print("Direct PDF URL:", pdf_url)
-        if not pdf_url:
-            continue
+    if MERGE_PRODUCTS:
+        base_list = merge_products_latest(all_products)
+    else:
+        base_list = all_products
+
+    products = base_list[:PRODUCT_LIMIT] if PRODUCT_LIMIT else base_list
 
-        download_pdf(pdf_url, p, om)
+    # network-bound: overlap page fetches, pdfLink calls and downloads across products
+    with ThreadPoolExecutor(max_workers=PARALLEL_PRODUCTS) as pool:
+        futures = [
+            pool.submit(process_product, idx, len(products), p, all_products)
+            for idx, p in enumerate(products, 1)
+        ]
+        for idx, fut in enumerate(futures, 1):
+            try:
+                fut.result()
+            except Exception as e:
+                print(f"[{idx}/{len(products)}] failed: {e}")
 
 if __name__ == "__main__":
     main()
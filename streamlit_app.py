@@ -1,9 +1,12 @@
 import os
 import io
 import re
+import json
 import traceback
 import streamlit as st
 from contextlib import redirect_stdout, redirect_stderr
+from smolagents.memory import ActionStep, FinalAnswerStep
+from smolagents.models import ChatMessageStreamDelta
 import agent_core
 
 
@@ -14,17 +17,19 @@ SQL_BLOCK_RE = re.compile(r"```sql\s*(.*?)```", re.IGNORECASE | re.DOTALL)
 SQL_ANY_BLOCK_RE = re.compile(r"```\s*(SELECT[\s\S]*?)```", re.IGNORECASE)
 
 def extract_citations(answer_text: str):
-    cites = CITATION_RE.findall(answer_text or "")
-    cites = [(fp.strip(), int(pg)) for fp, pg in cites]
+    cites = []
     unique_paths = []
     seen = set()
-    for fp, _ in cites:
+    for m in CITATION_RE.finditer(answer_text or ""):
+        fp = m.group(1).strip()
+        cites.append((fp, int(m.group(2))))
         if fp not in seen:
             unique_paths.append(fp)
             seen.add(fp)
     return cites, unique_paths
 
 def extract_sql(answer_text: str):
+    # ```sql blocks take priority over unlabeled SELECT blocks anywhere in the text
     m = SQL_BLOCK_RE.search(answer_text or "")
     if m:
         return m.group(1).strip()
@@ -33,35 +38,122 @@ def extract_sql(answer_text: str):
         return m.group(1).strip()
     return ""
 
+def prompt_mtime(path: str) -> float:
+    try:
+        return os.path.getmtime(path)
+    except OSError:
+        return 0.0
+
+# Tools (SQLite connection, Chroma collection) are heavy and thread-safe: share them
+# across sessions and re-runs. Agents hold per-run memory, so each session builds its own.
+# Failures raise instead of returning, so they are never cached for other sessions.
+@st.cache_resource(show_spinner="Loading tools...", max_entries=4)
+def load_tools(db_path: str, chroma_path: str, collection_name: str):
+    return agent_core.build_tools(
+        db_path=db_path,
+        chroma_dir=chroma_path,
+        collection_name=collection_name,
+    )
+
 def load_agent_with_logs(db_path: str, chroma_path: str, collection_name: str, system_prompt_path: str):
     out = io.StringIO()
     err = io.StringIO()
     with redirect_stdout(out), redirect_stderr(err):
         try:
-            agent = agent_core.build_agent(
-                db_path=db_path,
-                chroma_dir=chroma_path,
-                collection_name=collection_name,
-                system_prompt_path=system_prompt_path,
-            )
+            tools = load_tools(db_path, chroma_path, collection_name)
+            agent = agent_core.build_agent(system_prompt_path=system_prompt_path, tools=tools)
         except Exception:
             traceback.print_exc()
             agent = None
     logs = out.getvalue() + "\n" + err.getvalue()
     return agent, logs
 
-def run_agent_with_logs(agent, question: str):
-    out = io.StringIO()
-    err = io.StringIO()
-    result_text = ""
-    with redirect_stdout(out), redirect_stderr(err):
+FINAL_ANSWER_ARG_RE = re.compile(r'"answer"\s*:\s*"')
+
+def partial_answer_arg(arguments: str) -> str:
+    """Decoded text of the (possibly still incomplete) "answer" string in final_answer's JSON args."""
+    m = FINAL_ANSWER_ARG_RE.search(arguments)
+    if not m:
+        return ""
+    body = arguments[m.end():]
+    # cut at the closing quote, if it has arrived
+    i = 0
+    while i < len(body):
+        if body[i] == "\\":
+            i += 2
+            continue
+        if body[i] == '"':
+            body = body[:i]
+            break
+        i += 1
+    # a fragment may end inside an escape sequence (e.g. \u00): back off until it decodes
+    for cut in range(0, min(6, len(body)) + 1):
         try:
-            result_text = agent.run(question)
-        except Exception:
-            traceback.print_exc()
-            result_text = ""
-    logs = out.getvalue() + "\n" + err.getvalue()
-    return result_text, logs
+            text = json.loads('"' + body[:len(body) - cut] + '"')
+        except ValueError:
+            continue
+        # ...or between the two halves of a surrogate pair (\ud83d\ude00): hold the high half back
+        while text and "\ud800" <= text[-1] <= "\udbff":
+            text = text[:-1]
+        return text
+    return ""
+
+def displayable(text: str) -> str:
+    # lone surrogates can't be UTF-8 encoded for the browser
+    return text.encode("utf-8", "replace").decode("utf-8")
+
+def run_agent_with_logs(agent, question: str, on_progress=None):
+    """Run the agent in streaming mode.
+
+    Returns (answer_stream, logs): `answer_stream` yields the full answer text so far
+    (render each value in place), `logs` a StringIO that is complete once the stream is
+    exhausted.
+    Intermediate model output and tool calls are reported through `on_progress(text)`.
+    """
+    logs = io.StringIO()
+    on_progress = on_progress or (lambda text: None)
+
+    def answer_stream():
+        with redirect_stdout(logs), redirect_stderr(logs):
+            try:
+                streamed = ""          # final answer text shown so far
+                calls = {}             # tool-call index -> [name, arguments so far], per step
+                for event in agent.run(question, stream=True):
+                    if isinstance(event, ChatMessageStreamDelta):
+                        if event.content:
+                            on_progress(event.content)
+                        for tc in event.tool_calls or []:
+                            call = calls.setdefault(tc.index, ["", ""])
+                            fn = tc.function
+                            if fn is None:
+                                continue
+                            if fn.name and not call[0]:
+                                call[0] = fn.name
+                                if fn.name != "final_answer":
+                                    on_progress(f"\n\n`{fn.name}` ")
+                            call[1] += fn.arguments or ""
+                            if call[0] == "final_answer":
+                                # stream the answer argument token by token as it arrives
+                                text = partial_answer_arg(call[1])
+                                if len(text) > len(streamed):
+                                    streamed = displayable(text)
+                                    yield streamed
+                            elif call[0]:
+                                on_progress(fn.arguments or "")
+                    elif isinstance(event, ActionStep):
+                        calls = {}
+                        names = ", ".join(tc.name for tc in (event.tool_calls or []))
+                        on_progress(f"\n\n**Step {event.step_number}** {names}\n\n")
+                    elif isinstance(event, FinalAnswerStep):
+                        # authoritative text: replaces whatever was streamed
+                        final = displayable(str(event.output))
+                        if final != streamed:
+                            streamed = final
+                            yield final
+            except Exception:
+                traceback.print_exc()
+
+    return answer_stream(), logs
 
 
 # --------------------------- UI ---------------------------
@@ -84,10 +176,8 @@ st.divider()
 
 user_q = st.text_input("Ask a question", value="", placeholder="e.g., What is the standard Toyota warranty for Europe?")
 
-if "agent" not in st.session_state:
-    agent, build_logs = load_agent_with_logs(db_path, chroma_path, collection_name, system_prompt_path)
-    st.session_state.agent = agent
-    st.session_state.build_logs = build_logs
+# Rebuild this session's agent when any input or the system prompt file changes
+agent_key = (db_path, chroma_path, collection_name, system_prompt_path, prompt_mtime(system_prompt_path))
 
 # Buttons row
 btn_run_col, btn_reload_col = st.columns(2)
@@ -98,27 +188,50 @@ with btn_reload_col:
 
 # Handle reload
 if reload_clicked:
+    load_tools.clear()
+    st.session_state.pop("agent_key", None)
+
+if st.session_state.get("agent_key") != agent_key:
     agent, build_logs = load_agent_with_logs(db_path, chroma_path, collection_name, system_prompt_path)
     st.session_state.agent = agent
     st.session_state.build_logs = build_logs
+    st.session_state.agent_key = agent_key
+
+agent = st.session_state.agent
+build_logs = st.session_state.build_logs
+
+# Answer window
+st.subheader("Answer")
+answer_box = st.container()
 
 # Handle run
 answer_text = ""
 run_logs = ""
 if run_clicked:
-    if st.session_state.agent is None:
+    if agent is None:
         st.error("Agent is not initialized. Check logs below.")
     elif not user_q.strip():
         st.warning("Enter a question.")
     else:
-        answer_text, run_logs = run_agent_with_logs(st.session_state.agent, user_q)
+        status = answer_box.status("Working...", expanded=True)
+        progress = status.empty()
+        trace = []
 
-# Answer window
-st.subheader("Answer")
-if answer_text:
-    st.markdown(answer_text)
-else:
-    st.caption("No answer yet.")
+        def show_progress(text: str):
+            trace.append(text)
+            progress.markdown("".join(trace))
+
+        answer_stream, run_log_buf = run_agent_with_logs(
+            agent, user_q, on_progress=show_progress
+        )
+        answer_placeholder = answer_box.empty()
+        for answer_text in answer_stream:
+            answer_placeholder.markdown(answer_text)
+        status.update(label="Done", state="complete", expanded=False)
+        run_logs = run_log_buf.getvalue()
+
+if not answer_text:
+    answer_box.caption("No answer yet.")
 
 st.divider()
 
@@ -154,8 +267,8 @@ st.divider()
 # Debug window
 st.subheader("Debug logs")
 debug_text = ""
-if "build_logs" in st.session_state and st.session_state.build_logs:
-    debug_text += st.session_state.build_logs.strip() + "\n"
+if build_logs:
+    debug_text += build_logs.strip() + "\n"
 if run_logs:
     debug_text += run_logs.strip() + "\n"
 